@@ -0,0 +1,330 @@
+"""Load test the Flask routes against a seeded database.
+
+Starts gunicorn locally with ``benchmarks/stub_app.py`` for each worker count, seeds a scratch
+Postgres database with each subreddit count, and drives every route at each concurrency level,
+recording throughput and latency percentiles.  Results are saved as JSON named after the current
+git commit so runs can be compared across commits:
+
+    python benchmarks/load_test.py --database-url postgres://localhost/reddit_playlist_loadtest
+    python benchmarks/load_test.py --compare benchmarks/results/abc1234.json benchmarks/results/def5678.json
+
+The database given is wiped and reseeded, so never point it at a real database.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import datetime
+import threading
+import subprocess
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from reddit_playlist import database
+
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+RESULTS_FOLDER = os.path.join(ROOT, "benchmarks", "results")
+SEEDED_SUBREDDIT = "punk"
+
+
+def seed_database(n_subreddits):
+    """Reset the database and fill it with subreddits that each have a playlist for today.
+
+    Parameters
+    ----------
+    n_subreddits : int
+        How many subreddits to create
+
+    Returns
+    -------
+    None
+    """
+    db = database.DatabaseManager()
+    db._reset_database()
+    now = datetime.datetime.now()
+    subreddit_names = [SEEDED_SUBREDDIT] + \
+        ["loadtest{:05d}".format(i) for i in range(n_subreddits - 1)]
+    db.cur.executemany(
+        "INSERT INTO subreddit_playlists_created (subreddit_name, date_added) VALUES (%s, %s)",
+        [(subreddit_name, now) for subreddit_name in subreddit_names]
+    )
+    db.cur.executemany(
+        """INSERT INTO subreddit_playlists (playlist_id, date_created, subreddit_name)
+        VALUES (%s, %s, %s)""",
+        [("PL{}".format(subreddit_name), now, subreddit_name) for subreddit_name in subreddit_names]
+    )
+    db.conn.commit()
+    logger.info("Seeded {} subreddits".format(n_subreddits))
+
+    return None
+
+
+def _free_port():
+    """Find a free local port."""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return port
+
+
+def start_server(workers, add_latency):
+    """Start gunicorn serving the stubbed app and wait until it answers.
+
+    Parameters
+    ----------
+    workers : int
+        The number of gunicorn workers
+    add_latency : float
+        Seconds the stubbed playlist pipeline sleeps for
+
+    Returns
+    -------
+    tuple
+        (subprocess.Popen, base url)
+    """
+    port = _free_port()
+    env = dict(os.environ, LOADTEST_ADD_LATENCY=str(add_latency))
+    process = subprocess.Popen(
+        ["gunicorn", "--chdir", ROOT, "--workers", str(workers),
+         "--bind", "127.0.0.1:{}".format(port), "--log-level", "warning",
+         "benchmarks.stub_app:app"],
+        env=env
+    )
+    base_url = "http://127.0.0.1:{}".format(port)
+    for _ in range(100):
+        try:
+            requests.get(base_url + "/", allow_redirects=False, timeout=1)
+            return process, base_url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("gunicorn did not start on {}".format(base_url))
+
+
+def _percentile(sorted_values, percentile):
+    """Get a percentile from a sorted list using the nearest-rank method."""
+    if len(sorted_values) == 0:
+        return None
+    rank = int(round(percentile / 100 * (len(sorted_values) - 1)))
+
+    return sorted_values[rank]
+
+
+def run_route(base_url, route, concurrency, duration):
+    """Hammer a single route from several threads for a fixed time.
+
+    Parameters
+    ----------
+    base_url : str
+        The server url
+    route : str
+        One of "index", "subreddit_playlist" or "add_subreddit"
+    concurrency : int
+        The number of concurrent clients
+    duration : float
+        How many seconds to run for
+
+    Returns
+    -------
+    dict
+        Request and error counts, requests per second and latency percentiles in milliseconds
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(client_id):
+        session = requests.Session()
+        n = 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                if route == "index":
+                    response = session.get(base_url + "/", allow_redirects=False)
+                elif route == "subreddit_playlist":
+                    response = session.get(base_url + "/" + SEEDED_SUBREDDIT)
+                else:
+                    response = session.post(
+                        base_url + "/add",
+                        data={"subreddit_name": "r/loadtestadd{}x{}".format(client_id, n)},
+                        allow_redirects=False
+                    )
+                    # Nothing consumes the flashed message, so drop it rather than letting the
+                    # session cookie grow with every request
+                    session.cookies.clear()
+                ok = response.status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            n += 1
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    result = {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "requests_per_second": len(latencies) / elapsed,
+    }
+    for percentile in [50, 90, 99]:
+        latency = _percentile(latencies, percentile)
+        result["p{}_ms".format(percentile)] = None if latency is None else latency * 1000
+
+    return result
+
+
+def _git_commit():
+    """Get the short hash of the current git commit."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_sweep(args):
+    """Run every combination of subreddit count, worker count, route and concurrency.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        The parsed CLI args
+
+    Returns
+    -------
+    dict
+        The run metadata and a list of result rows
+    """
+    os.environ["DATABASE_URL"] = args.database_url
+    rows = []
+    for n_subreddits in args.subreddits:
+        seed_database(n_subreddits)
+        for workers in args.workers:
+            process, base_url = start_server(workers, args.add_latency)
+            try:
+                for route in args.routes:
+                    for concurrency in args.concurrency:
+                        result = run_route(base_url, route, concurrency, args.duration)
+                        result.update({
+                            "subreddits": n_subreddits,
+                            "workers": workers,
+                            "route": route,
+                            "concurrency": concurrency,
+                        })
+                        rows.append(result)
+                        logger.info("{route} subreddits={subreddits} workers={workers} "
+                                    "concurrency={concurrency}: {requests_per_second:.1f} req/s, "
+                                    "p50 {p50_ms} ms, p99 {p99_ms} ms, {errors} errors".format(**result))
+            finally:
+                process.terminate()
+                process.wait()
+
+    return {
+        "commit": _git_commit(),
+        "date": datetime.datetime.now().isoformat(),
+        "duration": args.duration,
+        "add_latency": args.add_latency,
+        "results": rows,
+    }
+
+
+def _row_key(row):
+    return row["route"], row["subreddits"], row["workers"], row["concurrency"]
+
+
+def compare(baseline_file, candidate_file):
+    """Print the throughput and p99 latency of two result files side by side."""
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    with open(candidate_file) as f:
+        candidate = json.load(f)
+
+    baseline_rows = {_row_key(row): row for row in baseline["results"]}
+    row_format = "{:<20} {:>10} {:>8} {:>12} {:>10} {:>10} {:>8} {:>10} {:>10}"
+    print(row_format.format("route", "subreddits", "workers", "concurrency",
+                            baseline["commit"] + " rps", candidate["commit"] + " rps", "change",
+                            "p99 before", "p99 after"))
+    for row in candidate["results"]:
+        before = baseline_rows.get(_row_key(row))
+        if before is None:
+            continue
+        change = (row["requests_per_second"] / before["requests_per_second"] - 1) * 100 \
+            if before["requests_per_second"] > 0 else float("nan")
+        print(row_format.format(row["route"], row["subreddits"], row["workers"], row["concurrency"],
+                                "{:.1f}".format(before["requests_per_second"]),
+                                "{:.1f}".format(row["requests_per_second"]),
+                                "{:+.1f}%".format(change),
+                                "{:.1f}".format(before["p99_ms"] or 0),
+                                "{:.1f}".format(row["p99_ms"] or 0)))
+
+
+def parse_args():
+    """Parse the CLI args"""
+    parser = argparse.ArgumentParser(description='Load test the Flask routes')
+    parser.add_argument("--database-url", dest="database_url",
+                        default=os.environ.get("LOADTEST_DATABASE_URL"),
+                        help="Scratch Postgres database to seed; it is wiped "
+                             "(default: $LOADTEST_DATABASE_URL)")
+    parser.add_argument("--subreddits", dest="subreddits", default=[10, 100, 1000], type=int,
+                        nargs="+", help="Subreddit counts to seed (default: 10 100 1000)")
+    parser.add_argument("--workers", dest="workers", default=[1, 2, 4], type=int, nargs="+",
+                        help="Gunicorn worker counts (default: 1 2 4)")
+    parser.add_argument("--concurrency", dest="concurrency", default=[1, 4, 16], type=int,
+                        nargs="+", help="Concurrent clients (default: 1 4 16)")
+    parser.add_argument("--routes", dest="routes", nargs="+",
+                        default=["index", "subreddit_playlist", "add_subreddit"],
+                        choices=["index", "subreddit_playlist", "add_subreddit"],
+                        help="Routes to test (default: all)")
+    parser.add_argument("--duration", dest="duration", default=10.0, type=float,
+                        help="Seconds per measurement (default: 10)")
+    parser.add_argument("--add-latency", dest="add_latency", default=0.0, type=float,
+                        help="Seconds the stubbed playlist pipeline takes (default: 0)")
+    parser.add_argument("--output", dest="output", default=None,
+                        help="Results file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", dest="compare", nargs=2, default=None,
+                        metavar=("BASELINE", "CANDIDATE"),
+                        help="Compare two results files instead of running")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    if args.compare is not None:
+        compare(*args.compare)
+    elif args.database_url is None:
+        sys.exit("A scratch database is required: pass --database-url or set LOADTEST_DATABASE_URL")
+    else:
+        results = run_sweep(args)
+        output = args.output
+        if output is None:
+            if not os.path.exists(RESULTS_FOLDER):
+                os.makedirs(RESULTS_FOLDER)
+            output = os.path.join(RESULTS_FOLDER, "{}.json".format(results["commit"]))
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info("Saved results to {}".format(output))
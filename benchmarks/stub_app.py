@@ -0,0 +1,23 @@
+"""The Flask app with external services stubbed out, for load testing.
+
+``create_and_or_update_playlist`` is replaced so ``/add`` never calls Reddit or YouTube.  Set
+``LOADTEST_ADD_LATENCY`` (seconds) to simulate the time the real pipeline takes.
+"""
+import os
+import time
+
+from reddit_playlist import app as reddit_playlist_app
+
+
+ADD_LATENCY = float(os.environ.get("LOADTEST_ADD_LATENCY", "0"))
+
+
+def create_and_or_update_playlist(subreddit_name):
+    """Stand-in for the Reddit and YouTube pipeline that only waits."""
+    time.sleep(ADD_LATENCY)
+
+    return 0
+
+
+reddit_playlist_app.create_and_or_update_playlist = create_and_or_update_playlist
+app = reddit_playlist_app.app
@@ -3,8 +3,10 @@ import logging
 import argparse
 from flask import Flask, g, request, flash, render_template, redirect, url_for
 
+from reddit_playlist import assets
 from reddit_playlist import database
 from reddit_playlist import reddit
+from reddit_playlist import rollup
 from reddit_playlist import youtube
 
 # Set up logging
@@ -14,9 +16,10 @@ logger = logging.getLogger(__name__)
 # Set up app
 app = Flask(__name__)
 app.secret_key = 'some secret'
+assets.init_app(app)
 
 
-def get_playlist_id(subreddit_name, date=datetime.datetime.now().date()):
+def get_playlist_id(subreddit_name, date=None):
     """Get the playlist for a particular subreddit and date.
 
     Parameters
@@ -31,6 +34,8 @@ def get_playlist_id(subreddit_name, date=datetime.datetime.now().date()):
     str
         playlist_id
     """
+    if date is None:
+        date = datetime.datetime.now().date()
     db = database.DatabaseManager()
     response = db.query(
         """
@@ -47,17 +52,21 @@ def get_playlist_id(subreddit_name, date=datetime.datetime.now().date()):
         return None
 
 
-def create_and_or_update_playlist(subreddit_name):
+def create_and_or_update_playlist(subreddit_name, update_rollups=False):
     """Create and/or update subreddit playlist
     
     Parameters
     ----------
     subreddit_name : str
         The subreddit name to create or update a playlist for
+    update_rollups : bool
+        Also merge the new videos into the weekly and monthly roll-ups (defaults to False).  Videos
+        skipped here are merged by the next run that does update them.
 
     Returns
     -------
-    None
+    int
+        The number of new videos added, or None if the subreddit could not be fetched
     """
     # Get posts from given subreddit
     try:
@@ -66,6 +75,7 @@ def create_and_or_update_playlist(subreddit_name):
         return None
     youtube_posts = reddit.filter_youtube_videos(posts)
     video_id_list = [post['video_id'] for post in youtube_posts]
+    posts_by_video_id = {post['video_id']: post for post in youtube_posts}
 
     # Connect to YouTube, get or create playlist, and add videos
     youtube_conn = youtube.YouTube("resources/client_secret.json")
@@ -73,9 +83,19 @@ def create_and_or_update_playlist(subreddit_name):
     playlist_id = get_playlist_id(subreddit_name)
     if playlist_id is None:
         playlist_id = youtube_conn.create_playlist(subreddit_name)
-    youtube_conn.bulk_add_videos_to_playlist(video_id_list, playlist_id)
+    n_added = youtube_conn.bulk_add_videos_to_playlist(video_id_list, playlist_id,
+                                                       posts=posts_by_video_id)
+    youtube_conn.database.insert_subreddit_update(subreddit_name, n_added)
 
-    return None
+    # Merge the new videos into the weekly and monthly roll-ups
+    if update_rollups and n_added > 0:
+        try:
+            rollup.update_rollup_playlists(youtube_conn, subreddit_name)
+        except Exception as e:
+            youtube_conn.database.conn.rollback()
+            logger.warning("Could not update roll-up playlists for {}: {}".format(subreddit_name, e))
+
+    return n_added
 
 
 def get_subreddits_available_in_db():
@@ -100,7 +120,7 @@ def bulk_create_and_or_update_playlists():
     subreddit_names = get_subreddits_available_in_db()
     for subreddit_name in subreddit_names:
         logger.info("Updating videos for {}!".format(subreddit_name))
-        create_and_or_update_playlist(subreddit_name)
+        create_and_or_update_playlist(subreddit_name, update_rollups=True)
 
 
 @app.route('/<string:subreddit_name>', methods=['GET'])
@@ -123,17 +143,46 @@ def index():
     return redirect(url_for('subreddit_playlist', subreddit_name="punk"))
 
 
+def delete_expired_playlists(max_age_days):
+    """Delete playlists older than the retention period.
+
+    Parameters
+    ----------
+    max_age_days : int
+        How many days of playlists to keep
+
+    Returns
+    -------
+    None
+    """
+    youtube_conn = youtube.YouTube("resources/client_secret.json")
+    youtube_conn.get_authenticated_service()
+    youtube_conn.delete_expired_playlists(max_age_days)
+
+    return None
+
+
 def parse_args():
     """Parse the CLI args"""
     parser = argparse.ArgumentParser(description='Update all of the playlists')
     parser.add_argument("--update-playlists", dest="update_playlist", default=False, action="store_true",
                         help="Update all of the playlists (default: False)")
+    parser.add_argument("--delete-expired-playlists", dest="max_age_days", default=None, type=int,
+                        metavar="DAYS",
+                        help="Delete playlists older than DAYS days from YouTube and the database")
+    parser.add_argument("--upgrade-database", dest="upgrade_database", default=False,
+                        action="store_true",
+                        help="Bring the database schema up to date (default: False)")
 
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_args()
-    if args.update_playlist:
+    if args.upgrade_database:
+        database.DatabaseManager().upgrade_database()
+    elif args.update_playlist:
         bulk_create_and_or_update_playlists()
+    elif args.max_age_days is not None:
+        delete_expired_playlists(args.max_age_days)
     else:
         app.run(host="0.0.0.0")
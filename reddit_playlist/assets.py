@@ -0,0 +1,247 @@
+"""Static asset pipeline.
+
+Builds content-hashed, minified and precompressed copies of the files in ``static`` into
+``static/dist`` and serves them with long-lived cache headers.
+"""
+import os
+import re
+import gzip
+import json
+import shutil
+import hashlib
+import logging
+import posixpath
+import mimetypes
+
+import brotli
+import rcssmin
+import rjsmin
+from flask import request, send_from_directory
+
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+DIST_FOLDER_NAME = "dist"
+MANIFEST_FILE_NAME = "manifest.json"
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".svg", ".eot", ".otf", ".ttf", ".ico"}
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+CSS_URL_PATTERN = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def _minify(filename, content):
+    """Minify CSS and JavaScript that is not already minified.
+
+    Parameters
+    ----------
+    filename : str
+        The file name, used to decide which minifier to use
+    content : bytes
+        The file contents
+
+    Returns
+    -------
+    bytes
+        The (possibly) minified contents
+    """
+    if ".min." in filename:
+        return content
+
+    if filename.endswith(".css"):
+        return rcssmin.cssmin(content.decode("utf-8")).encode("utf-8")
+    elif filename.endswith(".js"):
+        return rjsmin.jsmin(content.decode("utf-8")).encode("utf-8")
+
+    return content
+
+
+def _fingerprint(filename, content):
+    """Add a content hash to a file name.
+
+    Parameters
+    ----------
+    filename : str
+        A relative file name (e.g. css/custom.css)
+    content : bytes
+        The file contents
+
+    Returns
+    -------
+    str
+        The fingerprinted file name (e.g. css/custom.0123456789ab.css)
+    """
+    digest = hashlib.md5(content).hexdigest()[:12]
+    root, extension = os.path.splitext(filename)
+
+    return "{}.{}{}".format(root, digest, extension)
+
+
+def _rewrite_css_urls(filename, content, manifest):
+    """Point relative ``url()`` references in a stylesheet at their fingerprinted files.
+
+    Parameters
+    ----------
+    filename : str
+        The relative file name of the stylesheet (e.g. css/custom.css)
+    content : bytes
+        The stylesheet contents
+    manifest : dict
+        Original file names to fingerprinted file names, for every file the stylesheet uses
+
+    Returns
+    -------
+    bytes
+        The rewritten stylesheet
+    """
+    directory = posixpath.dirname(filename)
+
+    def rewrite(match):
+        quote, target = match.group(1), match.group(2).strip()
+        if target.startswith(("data:", "http:", "https:", "//", "/", "#")):
+            return match.group(0)
+        path, suffix = re.match(r"([^?#]*)(.*)", target).groups()
+        referenced_filename = posixpath.normpath(posixpath.join(directory, path))
+        if referenced_filename not in manifest:
+            logger.warning("{} references missing file {}".format(filename, referenced_filename))
+            return match.group(0)
+        fingerprinted_path = posixpath.join(posixpath.dirname(path),
+                                            posixpath.basename(manifest[referenced_filename]))
+
+        return "url({0}{1}{2}{0})".format(quote, fingerprinted_path, suffix)
+
+    return CSS_URL_PATTERN.sub(rewrite, content.decode("utf-8")).encode("utf-8")
+
+
+def _write_file(path, content):
+    """Write a file, creating its directory if needed."""
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def build_assets(static_folder=STATIC_FOLDER):
+    """Build the fingerprinted and precompressed static assets.
+
+    Every file is written to ``static/dist`` under its fingerprinted name, mirroring the layout of
+    ``static``.  Stylesheets are built last so their relative ``url()`` references can be
+    rewritten to the fingerprinted names of the fonts and images they use.  A manifest maps
+    original names to fingerprinted names.
+
+    Parameters
+    ----------
+    static_folder : str
+        The static folder to build (defaults to the app's static folder)
+
+    Returns
+    -------
+    dict
+        The manifest of original file names to fingerprinted file names
+    """
+    dist_folder = os.path.join(static_folder, DIST_FOLDER_NAME)
+    if os.path.exists(dist_folder):
+        shutil.rmtree(dist_folder)
+
+    filenames = []
+    for directory, directory_names, file_names in os.walk(static_folder):
+        if directory == static_folder and DIST_FOLDER_NAME in directory_names:
+            directory_names.remove(DIST_FOLDER_NAME)
+        for file_name in file_names:
+            path = os.path.join(directory, file_name)
+            filenames.append(os.path.relpath(path, static_folder).replace(os.sep, "/"))
+
+    manifest = {}
+    for filename in sorted(filenames, key=lambda filename: (filename.endswith(".css"), filename)):
+        with open(os.path.join(static_folder, filename), "rb") as f:
+            content = f.read()
+        if filename.endswith(".css"):
+            content = _rewrite_css_urls(filename, content, manifest)
+        content = _minify(filename, content)
+
+        fingerprinted_filename = _fingerprint(filename, content)
+        manifest[filename] = fingerprinted_filename
+        fingerprinted_path = os.path.join(dist_folder, fingerprinted_filename)
+        _write_file(fingerprinted_path, content)
+
+        if os.path.splitext(filename)[1] in COMPRESSIBLE_EXTENSIONS:
+            _write_file(fingerprinted_path + ".gz", gzip.compress(content, 9))
+            _write_file(fingerprinted_path + ".br", brotli.compress(content))
+
+        logger.debug("Built {} as {}".format(filename, fingerprinted_filename))
+
+    with open(os.path.join(dist_folder, MANIFEST_FILE_NAME), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    logger.info("Built {} static assets into {}".format(len(manifest), dist_folder))
+
+    return manifest
+
+
+def _load_manifest(dist_folder):
+    """Load the asset manifest, or an empty one if the assets have not been built."""
+    manifest_path = os.path.join(dist_folder, MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        logger.info("No asset manifest found, serving static files as-is")
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def init_app(app):
+    """Serve fingerprinted, precompressed assets from a Flask app once they have been built.
+
+    ``url_for('static', filename=...)`` emits fingerprinted URLs, and the static endpoint serves
+    the brotli or gzip variant according to ``Accept-Encoding`` with immutable cache headers.
+    When no manifest exists the app's normal static handling is left untouched.
+
+    Parameters
+    ----------
+    app : flask.Flask
+        The Flask app
+
+    Returns
+    -------
+    None
+    """
+    dist_folder = os.path.join(app.static_folder, DIST_FOLDER_NAME)
+    manifest = _load_manifest(dist_folder)
+    if len(manifest) == 0:
+        return None
+    fingerprinted_filenames = set(manifest.values())
+
+    @app.url_defaults
+    def fingerprint_static_url(endpoint, values):
+        if endpoint == "static" and values.get("filename") in manifest:
+            values["filename"] = manifest[values["filename"]]
+
+    def send_static_file(filename):
+        if filename not in fingerprinted_filenames:
+            return app.send_static_file(filename)
+
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        content_encoding = None
+        for encoding, extension in [("br", ".br"), ("gzip", ".gz")]:
+            if request.accept_encodings.quality(encoding) > 0 and \
+                    os.path.exists(os.path.join(dist_folder, filename + extension)):
+                content_encoding = encoding
+                filename += extension
+                break
+
+        response = send_from_directory(dist_folder, filename, mimetype=mimetype)
+        if content_encoding is not None:
+            response.headers["Content-Encoding"] = content_encoding
+        response.headers["Vary"] = "Accept-Encoding"
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+
+        return response
+
+    app.view_functions["static"] = send_static_file
+    logger.info("Serving {} fingerprinted static assets".format(len(manifest)))
+
+    return None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    build_assets()
@@ -10,6 +10,15 @@ import logging
 # Set up logging
 logger = logging.getLogger(__name__)
 
+# How long to wait before retrying a video that failed to insert.  The wait doubles with every
+# failed attempt up to the maximum, and failures not seen for VIDEO_FAILURE_TTL are forgotten.
+VIDEO_FAILURE_RETRY_BASE = datetime.timedelta(hours=6)
+VIDEO_FAILURE_RETRY_MAX = datetime.timedelta(days=30)
+VIDEO_FAILURE_TTL = datetime.timedelta(days=90)
+
+# How much subreddit update history to keep for the scheduler and its simulation
+SUBREDDIT_UPDATES_TTL = datetime.timedelta(days=30)
+
 
 class DatabaseManager:
     """A sqlite database object.
@@ -61,7 +70,8 @@ class DatabaseManager:
                 video_id TEXT PRIMARY KEY,
                 date_added TIMESTAMP,
                 playlist_id TEXT,
-                reddit_post_url TEXT
+                reddit_post_url TEXT,
+                score INTEGER
             )"""
         )
 
@@ -73,14 +83,110 @@ class DatabaseManager:
         )
 
         self.conn.commit()
+        self.upgrade_database()
 
         logger.info("Created tables!")
 
+    def upgrade_database(self):
+        """Bring an existing database up to date with the current schema.
+
+        Every step is idempotent, so this is safe to run on every deploy.
+
+        Returns
+        -------
+        None
+        """
+        self._create_retention_indexes()
+        self._create_video_failures_table()
+        self._create_subreddit_updates_table()
+        self._add_video_score_column()
+        self._create_rollup_tables()
+        logger.info("Upgraded database!")
+
+        return None
+
+    def _create_retention_indexes(self):
+        """Create the indexes used by the playlist retention cleanup if they do not exist yet."""
+        self.cur.execute(
+            """CREATE INDEX IF NOT EXISTS subreddit_playlists_date_created_idx
+            ON subreddit_playlists (date_created)"""
+        )
+        self.cur.execute(
+            """CREATE INDEX IF NOT EXISTS subreddit_playlist_videos_playlist_id_idx
+            ON subreddit_playlist_videos (playlist_id)"""
+        )
+        self.conn.commit()
+
+    def _create_video_failures_table(self):
+        """Create the video_insert_failures table if it does not exist yet."""
+        self.cur.execute(
+            """CREATE TABLE IF NOT EXISTS video_insert_failures (
+                video_id TEXT PRIMARY KEY,
+                error_class TEXT,
+                first_seen TIMESTAMP,
+                last_seen TIMESTAMP,
+                attempt_count INTEGER,
+                retry_after TIMESTAMP
+            )"""
+        )
+        self.conn.commit()
+
+    def _create_subreddit_updates_table(self):
+        """Create the subreddit_updates table if it does not exist yet."""
+        self.cur.execute(
+            """CREATE TABLE IF NOT EXISTS subreddit_updates (
+                subreddit_name TEXT,
+                date_updated TIMESTAMP,
+                new_videos INTEGER
+            )"""
+        )
+        self.cur.execute(
+            """CREATE INDEX IF NOT EXISTS subreddit_updates_subreddit_name_date_updated_idx
+            ON subreddit_updates (subreddit_name, date_updated)"""
+        )
+        self.conn.commit()
+
+    def _add_video_score_column(self):
+        """Add the score column to a subreddit_playlist_videos table created before it existed."""
+        self.cur.execute(
+            "ALTER TABLE subreddit_playlist_videos ADD COLUMN IF NOT EXISTS score INTEGER"
+        )
+        self.conn.commit()
+
+    def _create_rollup_tables(self):
+        """Create the rollup_playlists and rollup_playlist_videos tables if they do not exist yet."""
+        self.cur.execute(
+            """CREATE TABLE IF NOT EXISTS rollup_playlists (
+                playlist_id TEXT PRIMARY KEY,
+                subreddit_name TEXT,
+                period TEXT,
+                period_start DATE,
+                date_created TIMESTAMP,
+                updated_through TIMESTAMP,
+                UNIQUE (subreddit_name, period, period_start)
+            )"""
+        )
+        self.cur.execute(
+            """CREATE TABLE IF NOT EXISTS rollup_playlist_videos (
+                playlist_id TEXT,
+                video_id TEXT,
+                playlist_item_id TEXT,
+                score INTEGER,
+                date_added TIMESTAMP,
+                PRIMARY KEY (playlist_id, video_id)
+            )"""
+        )
+        self.conn.commit()
+
     def _delete_tables(self):
         """Delete subreddit_playlists and subreddit_playlist_videos tables."""
         self.cur.execute("DROP TABLE IF EXISTS subreddit_playlists")
         self.cur.execute("DROP TABLE IF EXISTS subreddit_playlist_videos")
         self.cur.execute("DROP TABLE IF EXISTS subreddit_playlists_created")
+        self.cur.execute("DROP TABLE IF EXISTS video_insert_failures")
+        self.cur.execute("DROP TABLE IF EXISTS subreddit_updates")
+        self.cur.execute("DROP TABLE IF EXISTS rollup_playlists")
+        self.cur.execute("DROP TABLE IF EXISTS rollup_playlist_videos")
         self.conn.commit()
         logger.info("Deleted tables!")
 
@@ -119,6 +225,42 @@ class DatabaseManager:
         logger.debug("Executed query\n{}\nwith parameters\n{}".format(sql, parameters))
         return cursor
 
+    def iter_query(self, sql, parameters=None, cursor_name="iter_query", itersize=1000):
+        """Stream the results of a query through a named server-side cursor.
+
+        Rows are fetched from Postgres ``itersize`` at a time instead of all at once.  The cursor
+        is declared ``WITH HOLD`` so other queries (and their commits) can run on this connection
+        while the results are being consumed.
+
+        Parameters
+        ----------
+        sql : str
+            A SQL query
+        parameters : Iterable
+            A list of parameters to insert (defaults to None)
+        cursor_name : str
+            The name of the server-side cursor (defaults to "iter_query")
+        itersize : int
+            How many rows to fetch per round trip (defaults to 1000)
+
+        Yields
+        ------
+        tuple
+            A result row
+        """
+        cursor = self.conn.cursor(name=cursor_name, withhold=True)
+        cursor.itersize = itersize
+        try:
+            cursor.execute(sql, parameters)
+            self.conn.commit()
+            logger.debug("Opened cursor {} for query\n{}\nwith parameters\n{}".format(
+                cursor_name, sql, parameters))
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+            self.conn.commit()
+
     def __del__(self):
         """Close the database connection when the object is deleted."""
         self.conn.close()
@@ -169,7 +311,7 @@ class DatabaseManager:
         )
         logger.info("Added playlist {} for subreddit {} to database".format(playlist_id, subreddit_name))
 
-    def get_playlist_id(self, subreddit_name, date=datetime.datetime.now().date()):
+    def get_playlist_id(self, subreddit_name, date=None):
         """Get the playlist for a particular subreddit and date.
         
         Parameters
@@ -184,6 +326,8 @@ class DatabaseManager:
         str
             playlist_id
         """
+        if date is None:
+            date = datetime.datetime.now().date()
         response = self.query(
             """
             SELECT playlist_id
@@ -198,7 +342,7 @@ class DatabaseManager:
         else:
             return None
 
-    def insert_video(self, video_id, playlist_id, reddit_post_url):
+    def insert_video(self, video_id, playlist_id, reddit_post_url, score=None):
         """Insert a playlist video into the subreddit_playlist_videos table.
         
         Parameters
@@ -209,26 +353,528 @@ class DatabaseManager:
             The YouTube playlist id
         reddit_post_url : str
             The reddit post url
+        score : int
+            The Reddit score of the post when the video was added (defaults to None)
 
         Returns
         -------
         None
         """
         self.query(
-            """INSERT INTO subreddit_playlist_videos(video_id, date_added, playlist_id, reddit_post_url)
-            VALUES (%s, %s, %s, %s)
+            """INSERT INTO subreddit_playlist_videos(video_id, date_added, playlist_id, reddit_post_url,
+                score)
+            VALUES (%s, %s, %s, %s, %s)
             """,
-            (video_id, datetime.datetime.now(), playlist_id, reddit_post_url)
+            (video_id, datetime.datetime.now(), playlist_id, reddit_post_url, score)
         )
 
-    def get_all_playlist_ids(self):
-        """Get all of the playlist ids."""
+    def get_rollup_playlist(self, subreddit_name, period, period_start):
+        """Get the roll-up playlist for a subreddit and period.
+
+        Parameters
+        ----------
+        subreddit_name : str
+            The name of the subreddit
+        period : str
+            "week" or "month"
+        period_start : datetime.date
+            The first day of the period
+
+        Returns
+        -------
+        tuple
+            (playlist_id, updated_through), or None if there is no roll-up playlist yet
+        """
         response = self.query(
-            """SELECT playlist_id
-            FROM subreddit_playlists
-            """
+            """SELECT playlist_id, updated_through
+            FROM rollup_playlists
+            WHERE subreddit_name = %s AND period = %s AND period_start = %s
+            """,
+            (subreddit_name, period, period_start)
         ).fetchall()
 
-        playlist_ids = [playlist_id[0] for playlist_id in response]
+        if len(response) > 0:
+            return response[0]
+        else:
+            return None
+
+    def insert_rollup_playlist(self, playlist_id, subreddit_name, period, period_start):
+        """Insert a created roll-up playlist into the rollup_playlists table.
 
-        return playlist_ids
+        Parameters
+        ----------
+        playlist_id : str
+            The YouTube id for the playlist
+        subreddit_name : str
+            The name of the subreddit
+        period : str
+            "week" or "month"
+        period_start : datetime.date
+            The first day of the period
+
+        Returns
+        -------
+        None
+        """
+        self.query(
+            """INSERT INTO rollup_playlists(playlist_id, subreddit_name, period, period_start,
+                date_created)
+            VALUES (%s, %s, %s, %s, %s)
+            """,
+            (playlist_id, subreddit_name, period, period_start, datetime.datetime.now())
+        )
+        logger.info("Added {} roll-up playlist {} for subreddit {} to database".format(
+            period, playlist_id, subreddit_name))
+
+    def set_rollup_updated_through(self, playlist_id, updated_through):
+        """Record the date_added of the newest daily video merged into a roll-up playlist.
+
+        Parameters
+        ----------
+        playlist_id : str
+            The YouTube id for the roll-up playlist
+        updated_through : datetime.datetime
+            The date_added of the newest merged video
+
+        Returns
+        -------
+        None
+        """
+        self.query(
+            "UPDATE rollup_playlists SET updated_through = %s WHERE playlist_id = %s",
+            (updated_through, playlist_id)
+        )
+
+    def get_new_rollup_candidates(self, subreddit_name, start, end, since=None):
+        """Get scored daily videos of a subreddit added in a time range.
+
+        Parameters
+        ----------
+        subreddit_name : str
+            The name of the subreddit
+        start : datetime.datetime
+            Only return videos added at or after this time
+        end : datetime.datetime
+            Only return videos added before this time
+        since : datetime.datetime
+            Only return videos added after this time (defaults to None)
+
+        Returns
+        -------
+        list of tuple
+            (video_id, score, date_added), oldest first
+        """
+        if since is None:
+            since = datetime.datetime.min
+        response = self.query(
+            """SELECT v.video_id, v.score, v.date_added
+            FROM subreddit_playlist_videos v
+            JOIN subreddit_playlists p ON v.playlist_id = p.playlist_id
+            WHERE p.subreddit_name = %s
+                AND v.date_added >= %s AND v.date_added < %s AND v.date_added > %s
+                AND v.score IS NOT NULL
+            ORDER BY v.date_added ASC
+            """,
+            (subreddit_name, start, end, since)
+        ).fetchall()
+
+        return response
+
+    def get_rollup_videos(self, playlist_id):
+        """Get the videos in a roll-up playlist, highest score first.
+
+        Parameters
+        ----------
+        playlist_id : str
+            The YouTube id for the roll-up playlist
+
+        Returns
+        -------
+        list of tuple
+            (video_id, score, playlist_item_id)
+        """
+        response = self.query(
+            """SELECT video_id, score, playlist_item_id
+            FROM rollup_playlist_videos
+            WHERE playlist_id = %s
+            ORDER BY score DESC, date_added ASC
+            """,
+            (playlist_id,)
+        ).fetchall()
+
+        return response
+
+    def insert_rollup_video(self, playlist_id, video_id, score, playlist_item_id):
+        """Insert a video into the rollup_playlist_videos table.
+
+        Parameters
+        ----------
+        playlist_id : str
+            The YouTube id for the roll-up playlist
+        video_id : str
+            The YouTube video id
+        score : int
+            The Reddit score of the video
+        playlist_item_id : str
+            The YouTube playlist item id
+
+        Returns
+        -------
+        None
+        """
+        self.query(
+            """INSERT INTO rollup_playlist_videos(playlist_id, video_id, playlist_item_id, score,
+                date_added)
+            VALUES (%s, %s, %s, %s, %s)
+            """,
+            (playlist_id, video_id, playlist_item_id, score, datetime.datetime.now())
+        )
+
+    def delete_rollup_video(self, playlist_id, video_id):
+        """Delete a video from the rollup_playlist_videos table.
+
+        Parameters
+        ----------
+        playlist_id : str
+            The YouTube id for the roll-up playlist
+        video_id : str
+            The YouTube video id
+
+        Returns
+        -------
+        None
+        """
+        self.query(
+            "DELETE FROM rollup_playlist_videos WHERE playlist_id = %s AND video_id = %s",
+            (playlist_id, video_id)
+        )
+
+    def insert_subreddit_update(self, subreddit_name, new_videos):
+        """Record how many new videos an update of a subreddit playlist added.
+
+        Parameters
+        ----------
+        subreddit_name : str
+            The name of the subreddit
+        new_videos : int
+            The number of videos added
+
+        Returns
+        -------
+        None
+        """
+        self.query(
+            """INSERT INTO subreddit_updates(subreddit_name, date_updated, new_videos)
+            VALUES (%s, %s, %s)
+            """,
+            (subreddit_name, datetime.datetime.now(), new_videos)
+        )
+
+        return None
+
+    def get_recent_subreddit_updates(self, subreddit_name, limit=10):
+        """Get the most recent updates of a subreddit playlist, oldest first.
+
+        Parameters
+        ----------
+        subreddit_name : str
+            The name of the subreddit
+        limit : int
+            How many updates to return (defaults to 10)
+
+        Returns
+        -------
+        list of tuple
+            (date_updated, new_videos) pairs
+        """
+        response = self.query(
+            """SELECT date_updated, new_videos
+            FROM subreddit_updates
+            WHERE subreddit_name = %s
+            ORDER BY date_updated DESC
+            LIMIT %s
+            """,
+            (subreddit_name, limit)
+        ).fetchall()
+
+        return [(date_updated, new_videos) for date_updated, new_videos in reversed(response)]
+
+    def iter_subreddit_updates(self, since=None):
+        """Stream recorded subreddit updates ordered by subreddit and time.
+
+        Parameters
+        ----------
+        since : datetime.datetime
+            Only return updates after this time (defaults to None, all updates)
+
+        Yields
+        ------
+        tuple
+            (subreddit_name, date_updated, new_videos)
+        """
+        if since is None:
+            since = datetime.datetime.min
+
+        return self.iter_query(
+            """SELECT subreddit_name, date_updated, new_videos
+            FROM subreddit_updates
+            WHERE date_updated > %s
+            ORDER BY subreddit_name ASC, date_updated ASC
+            """,
+            (since,),
+            cursor_name="subreddit_updates"
+        )
+
+    def prune_subreddit_updates(self, older_than):
+        """Delete subreddit updates recorded before a time.
+
+        Parameters
+        ----------
+        older_than : datetime.datetime
+            Delete updates recorded before this time
+
+        Returns
+        -------
+        None
+        """
+        self.query(
+            "DELETE FROM subreddit_updates WHERE date_updated < %s",
+            (older_than,)
+        )
+
+        return None
+
+    def get_failed_video_ids(self, now=None):
+        """Get the ids of videos that failed to insert and should not be retried yet.
+
+        Parameters
+        ----------
+        now : datetime.datetime
+            The current time (defaults to datetime.datetime.now())
+
+        Returns
+        -------
+        set of str
+            The video ids still backing off
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        response = self.query(
+            """SELECT video_id
+            FROM video_insert_failures
+            WHERE retry_after > %s
+            """,
+            (now,)
+        ).fetchall()
+
+        return {video_id[0] for video_id in response}
+
+    def record_video_failure(self, video_id, error_class, now=None):
+        """Record a failed insert for a video and push back its next retry.
+
+        Parameters
+        ----------
+        video_id : str
+            The YouTube video id
+        error_class : str
+            A short description of the error (e.g. "HttpError 404")
+        now : datetime.datetime
+            The current time (defaults to datetime.datetime.now())
+
+        Returns
+        -------
+        datetime.datetime
+            The time after which the video may be retried
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        response = self.query(
+            """SELECT first_seen, last_seen, attempt_count
+            FROM video_insert_failures
+            WHERE video_id = %s
+            """,
+            (video_id,)
+        ).fetchall()
+
+        if len(response) > 0 and response[0][1] > now - VIDEO_FAILURE_TTL:
+            first_seen, _, attempt_count = response[0]
+            attempt_count += 1
+        else:
+            first_seen, attempt_count = now, 1
+
+        retry_after = now + min(VIDEO_FAILURE_RETRY_BASE * 2 ** (attempt_count - 1),
+                                VIDEO_FAILURE_RETRY_MAX)
+        self.query(
+            """INSERT INTO video_insert_failures
+                (video_id, error_class, first_seen, last_seen, attempt_count, retry_after)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (video_id) DO UPDATE SET
+                error_class = EXCLUDED.error_class,
+                first_seen = EXCLUDED.first_seen,
+                last_seen = EXCLUDED.last_seen,
+                attempt_count = EXCLUDED.attempt_count,
+                retry_after = EXCLUDED.retry_after
+            """,
+            (video_id, error_class, first_seen, now, attempt_count, retry_after)
+        )
+        logger.info("Recorded failure {} for video {} (attempt {}), retrying after {}".format(
+            error_class, video_id, attempt_count, retry_after))
+
+        return retry_after
+
+    def prune_video_failures(self, now=None):
+        """Delete failures that have not been seen within VIDEO_FAILURE_TTL.
+
+        Parameters
+        ----------
+        now : datetime.datetime
+            The current time (defaults to datetime.datetime.now())
+
+        Returns
+        -------
+        None
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        self.query(
+            "DELETE FROM video_insert_failures WHERE last_seen < %s",
+            (now - VIDEO_FAILURE_TTL,)
+        )
+
+        return None
+
+    def iter_playlist_ids(self, created_before=None):
+        """Stream playlist ids, oldest first.
+
+        Parameters
+        ----------
+        created_before : datetime.datetime
+            Only return playlists created before this time (defaults to None, all playlists)
+
+        Yields
+        ------
+        str
+            playlist_id
+        """
+        if created_before is None:
+            rows = self.iter_query(
+                """SELECT playlist_id
+                FROM subreddit_playlists
+                ORDER BY date_created ASC
+                """,
+                cursor_name="playlist_ids"
+            )
+        else:
+            rows = self.iter_query(
+                """SELECT playlist_id
+                FROM subreddit_playlists
+                WHERE date_created < %s
+                ORDER BY date_created ASC
+                """,
+                (created_before,),
+                cursor_name="expired_playlist_ids"
+            )
+
+        for row in rows:
+            yield row[0]
+
+    def get_all_playlist_ids(self):
+        """Get all of the playlist ids."""
+        return list(self.iter_playlist_ids())
+
+    def delete_playlists(self, playlist_ids):
+        """Delete playlists and their videos from the database in a single transaction.
+
+        Callers are expected to pass bounded batches so each transaction stays small.
+
+        Parameters
+        ----------
+        playlist_ids : list of str
+            The YouTube playlist ids to delete
+
+        Returns
+        -------
+        None
+        """
+        playlist_ids = list(playlist_ids)
+        if len(playlist_ids) == 0:
+            return None
+
+        self.cur.execute(
+            "DELETE FROM subreddit_playlist_videos WHERE playlist_id = ANY(%s)",
+            (playlist_ids,)
+        )
+        self.cur.execute(
+            "DELETE FROM subreddit_playlists WHERE playlist_id = ANY(%s)",
+            (playlist_ids,)
+        )
+        self.conn.commit()
+        logger.info("Deleted {} playlists from the database".format(len(playlist_ids)))
+
+        return None
+
+    def iter_rollup_playlist_ids(self, ended_before=None):
+        """Stream roll-up playlist ids, oldest period first.
+
+        Parameters
+        ----------
+        ended_before : datetime.datetime
+            Only return roll-ups whose week or month ended by this time (defaults to None, all
+            roll-ups)
+
+        Yields
+        ------
+        str
+            playlist_id
+        """
+        if ended_before is None:
+            rows = self.iter_query(
+                """SELECT playlist_id
+                FROM rollup_playlists
+                ORDER BY period_start ASC
+                """,
+                cursor_name="rollup_playlist_ids"
+            )
+        else:
+            rows = self.iter_query(
+                """SELECT playlist_id
+                FROM rollup_playlists
+                WHERE period_start + CASE period WHEN 'week' THEN INTERVAL '7 days'
+                                                 ELSE INTERVAL '1 month' END <= %s
+                ORDER BY period_start ASC
+                """,
+                (ended_before,),
+                cursor_name="expired_rollup_playlist_ids"
+            )
+
+        for row in rows:
+            yield row[0]
+
+    def delete_rollup_playlists(self, playlist_ids):
+        """Delete roll-up playlists and their videos from the database in a single transaction.
+
+        Parameters
+        ----------
+        playlist_ids : list of str
+            The YouTube playlist ids to delete
+
+        Returns
+        -------
+        None
+        """
+        playlist_ids = list(playlist_ids)
+        if len(playlist_ids) == 0:
+            return None
+
+        self.cur.execute(
+            "DELETE FROM rollup_playlist_videos WHERE playlist_id = ANY(%s)",
+            (playlist_ids,)
+        )
+        self.cur.execute(
+            "DELETE FROM rollup_playlists WHERE playlist_id = ANY(%s)",
+            (playlist_ids,)
+        )
+        self.conn.commit()
+        logger.info("Deleted {} roll-up playlists from the database".format(len(playlist_ids)))
+
+        return None
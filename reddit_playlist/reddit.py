@@ -122,3 +122,22 @@ def get_subreddit_url(subreddit_name):
         A subreddit url
     """
     return "https://www.reddit.com/r/{}/".format(subreddit_name)
+
+
+def get_post_url(post):
+    """Get the url of a Reddit post.
+
+    Parameters
+    ----------
+    post : dict
+        A post dictionary
+
+    Returns
+    -------
+    str
+        The post url, or None if the post has no permalink
+    """
+    if "permalink" not in post:
+        return None
+
+    return "https://www.reddit.com{}".format(post["permalink"])
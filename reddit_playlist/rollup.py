@@ -0,0 +1,244 @@
+"""Weekly and monthly "best of" playlists built from the stored daily playlist videos.
+
+Roll-ups are updated incrementally: each run only merges the daily videos added since the last
+run, so keeping a roll-up current costs one playlist insert per video that makes the cut.
+"""
+import logging
+import argparse
+import datetime
+
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+PERIODS = ["week", "month"]
+ROLLUP_SIZE = 50
+
+
+def get_period_start(period, date):
+    """Get the first day of the week (Monday) or month containing a date.
+
+    Parameters
+    ----------
+    period : str
+        "week" or "month"
+    date : datetime.date
+        A date in the period
+
+    Returns
+    -------
+    datetime.date
+        The first day of the period
+    """
+    if period == "week":
+        return date - datetime.timedelta(days=date.weekday())
+    elif period == "month":
+        return date.replace(day=1)
+    else:
+        raise ValueError("{} is not a valid roll-up period!".format(period))
+
+
+def get_period_end(period, period_start):
+    """Get the first day after a week or month.
+
+    Parameters
+    ----------
+    period : str
+        "week" or "month"
+    period_start : datetime.date
+        The first day of the period
+
+    Returns
+    -------
+    datetime.date
+        The first day of the next period
+    """
+    if period == "week":
+        return period_start + datetime.timedelta(days=7)
+    elif period == "month":
+        return (period_start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    else:
+        raise ValueError("{} is not a valid roll-up period!".format(period))
+
+
+def _evict_lowest(youtube_conn, playlist_id, members, member_video_ids):
+    """Remove the lowest scoring video from a roll-up playlist.
+
+    Parameters
+    ----------
+    youtube_conn : youtube.YouTube
+        An authenticated YouTube connection
+    playlist_id : str
+        The roll-up playlist id
+    members : list of tuple
+        The (video_id, score, playlist_item_id) members, highest score first, updated in place
+    member_video_ids : set of str
+        The member video ids, updated in place
+
+    Returns
+    -------
+    bool
+        Whether the video was removed; if not it stays in the playlist and the database
+    """
+    video_id, _, playlist_item_id = members[-1]
+    try:
+        youtube_conn.delete_playlist_item(playlist_item_id)
+    except Exception as e:
+        logger.warning("Could not remove video {} from roll-up playlist {}: {}".format(
+            video_id, playlist_id, e))
+        return False
+    youtube_conn.database.delete_rollup_video(playlist_id, video_id)
+    members.pop()
+    member_video_ids.discard(video_id)
+
+    return True
+
+
+def update_rollup_playlist(youtube_conn, subreddit_name, period, date=None, size=ROLLUP_SIZE):
+    """Merge newly stored daily videos into a subreddit's roll-up playlist.
+
+    The playlist keeps the ``size`` highest scoring videos ordered by score.  Only videos added
+    since the last update are considered, and one that does not beat the lowest score of a full
+    playlist costs nothing.  A video is inserted before the lowest one is evicted, so a failed
+    eviction leaves the playlist oversized until the next run trims it rather than short.  An
+    insert failure that is not caused by the video itself stops the run, and the next run picks up
+    from the first candidate that was not handled.
+
+    Parameters
+    ----------
+    youtube_conn : youtube.YouTube
+        An authenticated YouTube connection
+    subreddit_name : str
+        The name of the subreddit
+    period : str
+        "week" or "month"
+    date : datetime.date
+        A date in the period (defaults to today)
+    size : int
+        The maximum number of videos in the playlist (defaults to 50)
+
+    Returns
+    -------
+    int
+        The number of videos added
+    """
+    if date is None:
+        date = datetime.datetime.now().date()
+    db = youtube_conn.database
+    period_start = get_period_start(period, date)
+    period_end = get_period_end(period, period_start)
+
+    rollup = db.get_rollup_playlist(subreddit_name, period, period_start)
+    updated_through = None if rollup is None else rollup[1]
+    candidates = db.get_new_rollup_candidates(
+        subreddit_name,
+        datetime.datetime.combine(period_start, datetime.time.min),
+        datetime.datetime.combine(period_end, datetime.time.min),
+        since=updated_through
+    )
+    if rollup is None:
+        if len(candidates) == 0:
+            return 0
+        playlist_id = youtube_conn.create_rollup_playlist(subreddit_name, period, period_start)
+    else:
+        playlist_id = rollup[0]
+
+    # (video_id, score, playlist_item_id), highest score first, mirroring the YouTube order
+    members = list(db.get_rollup_videos(playlist_id))
+    member_video_ids = {member[0] for member in members}
+
+    # Trim videos left behind by evictions that failed on an earlier run
+    while len(members) > size:
+        if not _evict_lowest(youtube_conn, playlist_id, members, member_video_ids):
+            return 0
+    if len(candidates) == 0:
+        return 0
+
+    ranked_candidates = sorted(candidates, key=lambda candidate: candidate[1], reverse=True)
+    n_added, n_handled = 0, 0
+    for video_id, score, _ in ranked_candidates:
+        if video_id in member_video_ids or (len(members) >= size and score <= members[-1][1]):
+            n_handled += 1
+            continue
+
+        position = len([member for member in members if member[1] >= score])
+        try:
+            playlist_item_id = youtube_conn.insert_playlist_item(video_id, playlist_id, position)
+        except Exception as e:
+            if not youtube_conn.is_permanent_video_error(e):
+                logger.warning("Stopping roll-up playlist {} update at video {}: {}".format(
+                    playlist_id, video_id, e))
+                break
+            logger.warning("Skipping video {} for roll-up playlist {}: {}".format(
+                video_id, playlist_id, e))
+            n_handled += 1
+            continue
+        db.insert_rollup_video(playlist_id, video_id, score, playlist_item_id)
+        members.insert(position, (video_id, score, playlist_item_id))
+        member_video_ids.add(video_id)
+        n_added += 1
+        n_handled += 1
+
+        if len(members) > size and not _evict_lowest(youtube_conn, playlist_id, members,
+                                                     member_video_ids):
+            break
+
+    # Candidates are handled by score but fetched by date_added, so only advance the watermark up
+    # to the last date_added before the earliest candidate that was not handled
+    unhandled_candidates = ranked_candidates[n_handled:]
+    if len(unhandled_candidates) == 0:
+        handled_through = candidates[-1][2]
+    else:
+        first_unhandled = min(candidate[2] for candidate in unhandled_candidates)
+        handled_dates = [candidate[2] for candidate in candidates if candidate[2] < first_unhandled]
+        handled_through = handled_dates[-1] if len(handled_dates) > 0 else None
+    if handled_through is not None:
+        db.set_rollup_updated_through(playlist_id, handled_through)
+    logger.info("Added {} videos to {} roll-up playlist {} for {}".format(
+        n_added, period, playlist_id, subreddit_name))
+
+    return n_added
+
+
+def update_rollup_playlists(youtube_conn, subreddit_name, date=None):
+    """Update the weekly and monthly roll-up playlists of a subreddit.
+
+    Parameters
+    ----------
+    youtube_conn : youtube.YouTube
+        An authenticated YouTube connection
+    subreddit_name : str
+        The name of the subreddit
+    date : datetime.date
+        A date in the periods to update (defaults to today)
+
+    Returns
+    -------
+    None
+    """
+    for period in PERIODS:
+        update_rollup_playlist(youtube_conn, subreddit_name, period, date)
+
+    return None
+
+
+def parse_args():
+    """Parse the CLI args"""
+    parser = argparse.ArgumentParser(description='Build the roll-up playlists from stored history')
+    parser.add_argument("--date", dest="date", default=None,
+                        type=lambda value: datetime.datetime.strptime(value, "%Y-%m-%d").date(),
+                        help="A date (YYYY-MM-DD) in the week and month to build (default: today)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+
+    from reddit_playlist import app
+    from reddit_playlist import youtube
+    youtube_conn = youtube.YouTube("resources/client_secret.json")
+    youtube_conn.get_authenticated_service()
+    for subreddit_name in app.get_subreddits_available_in_db():
+        update_rollup_playlists(youtube_conn, subreddit_name, args.date)
@@ -0,0 +1,352 @@
+"""Adaptive per-subreddit playlist update scheduler.
+
+Each subreddit is updated on its own schedule: subreddits that keep producing new videos are
+updated more often, and idle ones back off.  The scheduler is long-running and replaces the fixed
+``--update-playlists`` cron run.
+"""
+import time
+import heapq
+import logging
+import argparse
+import datetime
+import functools
+from collections import defaultdict
+
+from reddit_playlist import database
+
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class UpdatePolicy:
+    """Decide how long to wait before updating a subreddit again."""
+
+    def __init__(self, min_interval=datetime.timedelta(minutes=30),
+                 max_interval=datetime.timedelta(days=1), target_new_videos=3, window=10,
+                 idle_backoff=2.0):
+        """Initialize the update policy.
+
+        Parameters
+        ----------
+        min_interval : datetime.timedelta
+            The shortest time between updates (defaults to 30 minutes)
+        max_interval : datetime.timedelta
+            The longest time between updates (defaults to one day)
+        target_new_videos : float
+            How many new videos each update should find on average (defaults to 3)
+        window : int
+            How many recent updates to estimate the new-video rate from (defaults to 10)
+        idle_backoff : float
+            How much to stretch the interval after an update finds nothing (defaults to 2.0)
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_new_videos = target_new_videos
+        self.window = window
+        self.idle_backoff = idle_backoff
+
+    def next_interval(self, updates):
+        """Compute the time until the next update.
+
+        Parameters
+        ----------
+        updates : list of tuple
+            Recent (date_updated, new_videos) pairs, oldest first
+
+        Returns
+        -------
+        datetime.timedelta
+            The time to wait after the latest update
+        """
+        updates = updates[-self.window:]
+        if len(updates) < 2:
+            return self.min_interval
+
+        if updates[-1][1] == 0:
+            interval = (updates[-1][0] - updates[-2][0]) * self.idle_backoff
+        else:
+            # Videos found by the first update in the window arrived before the window started
+            new_videos = sum([new_videos for _, new_videos in updates[1:]])
+            interval = (updates[-1][0] - updates[0][0]) * self.target_new_videos / new_videos
+
+        return max(self.min_interval, min(self.max_interval, interval))
+
+
+class Scheduler:
+    """Keep a priority queue of subreddits by next-due time and update them when due."""
+
+    def __init__(self, policy=None, refresh_interval=datetime.timedelta(minutes=15),
+                 retry_interval=datetime.timedelta(minutes=1)):
+        """Initialize the scheduler.
+
+        Parameters
+        ----------
+        policy : UpdatePolicy
+            The update policy (defaults to UpdatePolicy())
+        refresh_interval : datetime.timedelta
+            How often to look for newly added subreddits (defaults to 15 minutes)
+        retry_interval : datetime.timedelta
+            How long to wait before retrying a failed refresh (defaults to 1 minute)
+        """
+        self.policy = policy if policy is not None else UpdatePolicy()
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.database = database.DatabaseManager()
+        self.queue = []
+        self.history = {}
+
+    def _schedule(self, subreddit_name):
+        """Push a subreddit onto the queue at its next due time."""
+        updates = self.history[subreddit_name]
+        if len(updates) == 0:
+            due = datetime.datetime.now()
+        else:
+            due = updates[-1][0] + self.policy.next_interval(updates)
+        heapq.heappush(self.queue, (due, subreddit_name))
+        logger.info("Next update of {} due at {}".format(subreddit_name, due))
+
+    def refresh(self, subreddit_names):
+        """Add subreddits that are not scheduled yet, seeding them with their recorded history.
+
+        Parameters
+        ----------
+        subreddit_names : list of str
+            All of the subreddit names
+
+        Returns
+        -------
+        None
+        """
+        for subreddit_name in subreddit_names:
+            if subreddit_name not in self.history:
+                self.history[subreddit_name] = self.database.get_recent_subreddit_updates(
+                    subreddit_name, limit=self.policy.window)
+                self._schedule(subreddit_name)
+
+        return None
+
+    def _reset_database(self):
+        """Roll back a failed transaction, reconnecting if the connection was lost."""
+        try:
+            if self.database.conn.closed:
+                logger.info("Reconnecting to the database")
+                self.database = database.DatabaseManager()
+            else:
+                self.database.conn.rollback()
+        except Exception as e:
+            logger.exception("Could not reset the database connection: {}".format(e))
+
+        return None
+
+    def run_due(self, update_subreddit, now=None):
+        """Update every subreddit whose due time has passed.
+
+        Parameters
+        ----------
+        update_subreddit : callable
+            Called with a subreddit name, returns the number of new videos added or None on failure
+        now : datetime.datetime
+            The current time (defaults to datetime.datetime.now())
+
+        Returns
+        -------
+        None
+        """
+        if now is None:
+            now = datetime.datetime.now()
+
+        while len(self.queue) > 0 and self.queue[0][0] <= now:
+            _, subreddit_name = heapq.heappop(self.queue)
+            logger.info("Updating videos for {}!".format(subreddit_name))
+            try:
+                new_videos = update_subreddit(subreddit_name)
+            except Exception as e:
+                logger.exception("Could not update {}: {}".format(subreddit_name, e))
+                new_videos = None
+            # A failed update counts as an idle one so broken subreddits back off
+            updates = self.history[subreddit_name]
+            updates.append((datetime.datetime.now(), new_videos or 0))
+            del updates[:-self.policy.window]
+            self._schedule(subreddit_name)
+
+        return None
+
+    def run_forever(self, update_subreddit, get_subreddit_names):
+        """Update subreddits as they become due, forever.
+
+        Parameters
+        ----------
+        update_subreddit : callable
+            Called with a subreddit name, returns the number of new videos added or None on failure
+        get_subreddit_names : callable
+            Returns all of the subreddit names
+
+        Returns
+        -------
+        None
+        """
+        next_refresh = datetime.datetime.min
+        while True:
+            now = datetime.datetime.now()
+            if now >= next_refresh:
+                try:
+                    self.refresh(get_subreddit_names())
+                    next_refresh = now + self.refresh_interval
+                except Exception as e:
+                    logger.exception("Could not refresh the subreddits: {}".format(e))
+                    self._reset_database()
+                    next_refresh = now + self.retry_interval
+
+            self.run_due(update_subreddit)
+
+            next_wake = next_refresh
+            if len(self.queue) > 0:
+                next_wake = min(next_wake, self.queue[0][0])
+            time.sleep(max(0, (next_wake - datetime.datetime.now()).total_seconds()))
+
+
+def _simulate_subreddit(arrivals, start, end, next_interval):
+    """Replay recorded video arrivals against an update policy.
+
+    The schedule always finishes with an update at ``end`` so every arrival is counted.
+
+    Parameters
+    ----------
+    arrivals : list of tuple
+        (date_updated, new_videos) pairs, oldest first, used as the times videos appeared
+    start : datetime.datetime
+        When the simulation starts
+    end : datetime.datetime
+        When the simulation ends
+    next_interval : callable
+        Called with the simulated (date_updated, new_videos) history, returns a timedelta
+
+    Returns
+    -------
+    tuple
+        (number of updates, number of videos, total delay in hours between arrival and update)
+    """
+    history = []
+    n_videos, total_delay = 0, 0.0
+    i = 0
+    now = start
+    while True:
+        now = min(now, end)
+        new_videos = 0
+        while i < len(arrivals) and arrivals[i][0] <= now:
+            new_videos += arrivals[i][1]
+            total_delay += arrivals[i][1] * (now - arrivals[i][0]).total_seconds() / 3600
+            i += 1
+        history.append((now, new_videos))
+        n_videos += new_videos
+        if now >= end:
+            break
+        now += next_interval(history)
+
+    return len(history), n_videos, total_delay
+
+
+def simulate(updates, policy, fixed_interval):
+    """Compare an update policy against a fixed schedule over recorded history.
+
+    Videos are assumed to appear at the time the update that found them ran, because that is all
+    the history records.  A fixed schedule matching the one that produced the history (e.g. the
+    daily cron) therefore always shows zero delay; compare delays between policies rather than
+    against that baseline.
+
+    Parameters
+    ----------
+    updates : Iterable of tuple
+        (subreddit_name, date_updated, new_videos) rows ordered by subreddit and time
+    policy : UpdatePolicy
+        The policy to evaluate
+    fixed_interval : datetime.timedelta
+        The fixed schedule to compare against
+
+    Returns
+    -------
+    dict
+        Subreddit name to {"policy": ..., "fixed": ...} results from _simulate_subreddit
+    """
+    arrivals_by_subreddit = defaultdict(list)
+    for subreddit_name, date_updated, new_videos in updates:
+        arrivals_by_subreddit[subreddit_name].append((date_updated, new_videos))
+
+    results = {}
+    for subreddit_name, arrivals in arrivals_by_subreddit.items():
+        start, end = arrivals[0][0], arrivals[-1][0]
+        results[subreddit_name] = {
+            "policy": _simulate_subreddit(arrivals, start, end, policy.next_interval),
+            "fixed": _simulate_subreddit(arrivals, start, end, lambda history: fixed_interval),
+        }
+
+    return results
+
+
+def print_simulation(results):
+    """Print simulation results as a table, with totals."""
+    row_format = "{:<24} {:>8} {:>8} {:>10} {:>8} {:>10}"
+    print(row_format.format("", "", "policy", "", "fixed", ""))
+    print(row_format.format("subreddit", "videos", "updates", "delay (h)",
+                            "updates", "delay (h)"))
+    totals = {"policy": [0, 0, 0.0], "fixed": [0, 0, 0.0]}
+
+    def mean_delay(n_videos, delay):
+        return "{:.2f}".format(delay / n_videos if n_videos > 0 else 0.0)
+
+    for subreddit_name, result in sorted(results.items()):
+        n_updates, n_videos, delay = result["policy"]
+        fixed_updates, fixed_videos, fixed_delay = result["fixed"]
+        print(row_format.format(subreddit_name, n_videos, n_updates, mean_delay(n_videos, delay),
+                                fixed_updates, mean_delay(fixed_videos, fixed_delay)))
+        for schedule in totals:
+            totals[schedule] = [total + value
+                                for total, value in zip(totals[schedule], result[schedule])]
+
+    n_updates, n_videos, delay = totals["policy"]
+    fixed_updates, fixed_videos, fixed_delay = totals["fixed"]
+    print(row_format.format("TOTAL", n_videos, n_updates, mean_delay(n_videos, delay),
+                            fixed_updates, mean_delay(fixed_videos, fixed_delay)))
+    print("Note: videos are assumed to appear when the recorded update found them, so a fixed "
+          "schedule matching the recorded one shows no delay.")
+
+
+def parse_args():
+    """Parse the CLI args"""
+    parser = argparse.ArgumentParser(description='Update playlists on an adaptive schedule')
+    parser.add_argument("--simulate", dest="simulate", default=False, action="store_true",
+                        help="Replay recorded history instead of updating (default: False)")
+    parser.add_argument("--days", dest="days", default=30, type=int,
+                        help="How many days of history to simulate (default: 30)")
+    parser.add_argument("--fixed-interval-hours", dest="fixed_interval_hours", default=24.0,
+                        type=float, help="Fixed schedule to compare against (default: 24)")
+    parser.add_argument("--min-interval-minutes", dest="min_interval_minutes", default=30.0,
+                        type=float, help="Shortest time between updates (default: 30)")
+    parser.add_argument("--max-interval-hours", dest="max_interval_hours", default=24.0,
+                        type=float, help="Longest time between updates (default: 24)")
+    parser.add_argument("--target-new-videos", dest="target_new_videos", default=3.0, type=float,
+                        help="New videos each update should find on average (default: 3)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    policy = UpdatePolicy(
+        min_interval=datetime.timedelta(minutes=args.min_interval_minutes),
+        max_interval=datetime.timedelta(hours=args.max_interval_hours),
+        target_new_videos=args.target_new_videos
+    )
+    if args.simulate:
+        since = datetime.datetime.now() - datetime.timedelta(days=args.days)
+        results = simulate(database.DatabaseManager().iter_subreddit_updates(since=since),
+                           policy, datetime.timedelta(hours=args.fixed_interval_hours))
+        print_simulation(results)
+    else:
+        from reddit_playlist import app
+        Scheduler(policy).run_forever(
+            functools.partial(app.create_and_or_update_playlist, update_rollups=True),
+            app.get_subreddits_available_in_db
+        )
@@ -1 +0,0 @@
-python reddit_playlist/app.py --update-playlists
\ No newline at end of file
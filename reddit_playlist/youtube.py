@@ -1,21 +1,29 @@
 """YouTube API interactions."""
 import os
+import json
 import datetime
 import logging
 import sys
+from itertools import islice
 
 from oauth2client.client import flow_from_clientsecrets
 from oauth2client.file import Storage
 from oauth2client.tools import argparser, run_flow
 from httplib2 import Http
 from apiclient.discovery import build
+from apiclient.errors import HttpError
 
 from reddit_playlist import database
+from reddit_playlist import reddit
 
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+# playlistItems.insert error reasons that are caused by the video rather than by the playlist,
+# the credentials or the quota
+VIDEO_ERROR_REASONS = {"videoNotFound", "invalidResourceId", "forbidden"}
+
 
 class YouTube:
     """
@@ -36,6 +44,7 @@ class YouTube:
         self.youtube_api_version = "v3"
         self.youtube = None
         self.database = database.DatabaseManager()
+        self._failed_video_ids = None
 
     def _create_secrets_file(self, client_secrets_file):
         """Create a secrets file from the environment variables since the flow needs one.
@@ -105,7 +114,7 @@ class YouTube:
 
         return resource
 
-    def create_playlist(self, subreddit, date=datetime.datetime.now().date()):
+    def create_playlist(self, subreddit, date=None):
         """Create a YouTube playlist.
         
         Parameters
@@ -113,18 +122,68 @@ class YouTube:
         subreddit : str
             Subreddit name
         date : str or datetime object
-            The date of the playlist
+            The date of the playlist (defaults to today)
         
         Returns
         -------
         str
             The playlist id
         """
+        if date is None:
+            date = datetime.datetime.now().date()
         logger.info("Creating playlist for the subreddit {}!".format(subreddit))
+        playlist_id = self._insert_playlist("{} playlist for {}".format(subreddit, date))
+
+        self.database.add_subreddit_to_db(subreddit)
+        self.database.insert_playlist(playlist_id, subreddit)
+    
+        return playlist_id
+
+    def create_rollup_playlist(self, subreddit, period, period_start):
+        """Create a "best of" YouTube playlist for a week or month.
+
+        Parameters
+        ----------
+        subreddit : str
+            Subreddit name
+        period : str
+            "week" or "month"
+        period_start : datetime.date
+            The first day of the period
+
+        Returns
+        -------
+        str
+            The playlist id
+        """
+        logger.info("Creating {} roll-up playlist for the subreddit {}!".format(period, subreddit))
+        if period == "week":
+            title = "{} best of the week of {}".format(subreddit, period_start)
+        else:
+            title = "{} best of {}".format(subreddit, period_start.strftime("%B %Y"))
+        playlist_id = self._insert_playlist(title)
+
+        self.database.insert_rollup_playlist(playlist_id, subreddit, period, period_start)
+
+        return playlist_id
+
+    def _insert_playlist(self, title):
+        """Create a public YouTube playlist.
+
+        Parameters
+        ----------
+        title : str
+            The playlist title, also used as its description
+
+        Returns
+        -------
+        str
+            The playlist id
+        """
         playlist_resource = self._build_resource(
             {
-                "snippet.title": "{} playlist for {}".format(subreddit, date),
-                "snippet.description": "{} playlist for {}".format(subreddit, date),
+                "snippet.title": title,
+                "snippet.description": title,
                 "status.privacyStatus": "public"
             }
         )
@@ -133,15 +192,134 @@ class YouTube:
             body=playlist_resource
         ).execute()
 
-        self.database.add_subreddit_to_db(subreddit)
-        self.database.insert_playlist(playlists_insert_response["id"], subreddit)
-    
         logger.info("Created new playlist with id: {}".format(
                     playlists_insert_response["id"]))
-    
+
         return playlists_insert_response["id"]
 
-    def add_video_to_playlist(self, video_id, playlist_id, reddit_post_url):
+    def insert_playlist_item(self, video_id, playlist_id, position=0):
+        """Insert a video into a playlist at a given position.
+
+        Parameters
+        ----------
+        video_id : str
+            The id for a YouTube video
+        playlist_id : str
+            The id for a YouTube playlist
+        position : int
+            The zero-based position in the playlist (defaults to 0, the top)
+
+        Returns
+        -------
+        str
+            The playlist item id
+        """
+        playlist_item = self._build_resource(
+            {
+                'snippet.playlistId': playlist_id,
+                'snippet.resourceId.kind': 'youtube#video',
+                'snippet.resourceId.videoId': video_id,
+                'snippet.position': position
+            }
+        )
+        playlist_items_insert_response = self.youtube.playlistItems().insert(
+            part="snippet",
+            body=playlist_item
+        ).execute()
+
+        return playlist_items_insert_response["id"]
+
+    def delete_playlist_item(self, playlist_item_id):
+        """Remove a video from a playlist.  A playlist item that no longer exists counts as removed.
+
+        Parameters
+        ----------
+        playlist_item_id : str
+            The YouTube playlist item id
+
+        Returns
+        -------
+        None
+        """
+        try:
+            self.youtube.playlistItems().delete(id=playlist_item_id).execute()
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            logger.info("Playlist item {} was already removed".format(playlist_item_id))
+
+        return None
+
+    @staticmethod
+    def is_permanent_video_error(exception):
+        """Check whether an insert error is caused by the video itself rather than by the
+        playlist, the credentials, quota or a transient server problem.
+
+        Parameters
+        ----------
+        exception : Exception
+            The error raised while inserting the video
+
+        Returns
+        -------
+        bool
+            True if retrying the same video soon is pointless
+        """
+        if not isinstance(exception, HttpError) or exception.resp.status not in (400, 403, 404):
+            return False
+        content = exception.content.decode("utf-8", "replace") \
+            if isinstance(exception.content, bytes) else str(exception.content)
+        try:
+            errors = json.loads(content)["error"]["errors"]
+            reasons = {error["reason"] for error in errors}
+        except (ValueError, KeyError, TypeError):
+            return False
+
+        return len(reasons) > 0 and reasons <= VIDEO_ERROR_REASONS
+
+    def _get_failed_video_ids(self):
+        """Get the ids of videos that recently failed to insert, loading them once per instance.
+
+        Returns
+        -------
+        set of str
+            The video ids to skip
+        """
+        if self._failed_video_ids is None:
+            try:
+                self._failed_video_ids = self.database.get_failed_video_ids()
+            except Exception as e:
+                self.database.conn.rollback()
+                logger.warning("Could not load video failures: {}".format(e))
+                self._failed_video_ids = set()
+
+        return self._failed_video_ids
+
+    def _record_video_failure(self, video_id, exception):
+        """Record a failed insert so the video is skipped until its backoff expires.
+
+        Parameters
+        ----------
+        video_id : str
+            The id for a YouTube video
+        exception : HttpError
+            The error raised by the YouTube API
+
+        Returns
+        -------
+        None
+        """
+        try:
+            self.database.record_video_failure(
+                video_id, "{} {}".format(type(exception).__name__, exception.resp.status))
+            self._get_failed_video_ids().add(video_id)
+        except Exception as e:
+            self.database.conn.rollback()
+            logger.warning("Could not record failure for video {}: {}".format(video_id, e))
+
+        return None
+
+    def add_video_to_playlist(self, video_id, playlist_id, reddit_post_url, score=None):
         """Add a single video an existing playlist.
         
         Parameters
@@ -150,34 +328,35 @@ class YouTube:
             The id for a YouTube video
         playlist_id : str
             The id for a YouTube playlist
+        reddit_post_url : str
+            The reddit post url
+        score : int
+            The Reddit score of the post when the video was added (defaults to None)
             
         Returns
         -------
-        None
+        bool
+            Whether the video was added
         """
         try:
             logger.debug("Adding video {} to playlist {}".format(video_id, playlist_id))
-            playlist_item = self._build_resource(
-                {
-                    'snippet.playlistId': playlist_id,
-                    'snippet.resourceId.kind': 'youtube#video',
-                    'snippet.resourceId.videoId': video_id,
-                    'snippet.position': 0
-                }
-            )
-            self.youtube.playlistItems().insert(
-                part="snippet",
-                body=playlist_item
-            ).execute()
-
-            self.database.insert_video(video_id, playlist_id, reddit_post_url)
+            try:
+                self.insert_playlist_item(video_id, playlist_id)
+            except HttpError as e:
+                if self.is_permanent_video_error(e):
+                    self._record_video_failure(video_id, e)
+                raise
+
+            self.database.insert_video(video_id, playlist_id, reddit_post_url, score)
             logger.info("Added video {} to playlist {}".format(video_id, playlist_id))
         except:
+            self.database.conn.rollback()
             logging.warning("Skipping video {}".format(video_id))
+            return False
     
-        return None
+        return True
     
-    def get_playlist_id_for_today(self, subreddit, date=datetime.datetime.now().date()):
+    def get_playlist_id_for_today(self, subreddit, date=None):
         """Get the playlist id for today's playlist.
     
         Parameters
@@ -191,6 +370,8 @@ class YouTube:
         -------
         None
         """
+        if date is None:
+            date = datetime.datetime.now().date()
         playlist_ids = self.youtube.playlists().list(
             part="snippet",
             mine=True
@@ -203,7 +384,7 @@ class YouTube:
 
         return None
 
-    def bulk_add_videos_to_playlist(self, video_id_list, playlist_id):
+    def bulk_add_videos_to_playlist(self, video_id_list, playlist_id, posts=None):
         """Add several videos to a playlist.
     
         Parameters
@@ -212,10 +393,14 @@ class YouTube:
             A list of video ids to add
         playlist_id : str
             The id for a YouTube playlist
+        posts : dict
+            Reddit post dictionaries keyed by video id, used to store the post url and score
+            (defaults to None)
         
         Returns
         -------
-        None
+        int
+            The number of videos added
         """
         # Get current video id list
         response = self.youtube.playlistItems().list(
@@ -229,18 +414,27 @@ class YouTube:
         for video in response['items']:
             current_video_ids.append(video['snippet']['resourceId']['videoId'])
     
+        if posts is None:
+            posts = {}
+        failed_video_ids = self._get_failed_video_ids()
+        n_added = 0
         for new_video_id in video_id_list:
-            if new_video_id not in current_video_ids:
-                self.add_video_to_playlist(video_id=new_video_id,
-                                           playlist_id=playlist_id,
-                                           reddit_post_url="test")
+            if new_video_id in failed_video_ids:
+                logger.info("Skipping video {} that recently failed to insert".format(new_video_id))
+            elif new_video_id not in current_video_ids:
+                post = posts.get(new_video_id, {})
+                if self.add_video_to_playlist(video_id=new_video_id,
+                                              playlist_id=playlist_id,
+                                              reddit_post_url=reddit.get_post_url(post),
+                                              score=post.get("score")):
+                    n_added += 1
             else:
                 logger.info("Skipping video {0} in playlist {1}".format(
                     new_video_id,
                     playlist_id
                 ))
     
-        return None
+        return n_added
 
     @staticmethod
     def get_playlist_url(playlist_id):
@@ -273,15 +467,119 @@ class YouTube:
 
         return None
 
-    def _delete_all_playlists(self):
-        """Delete all of the playlists in the database."""
-        playlist_ids = self.database.get_all_playlist_ids()
+    def _delete_playlists(self, playlist_ids):
+        """Delete several playlists at once using a single batch request.
+
+        Parameters
+        ----------
+        playlist_ids : list of str
+            A list of YouTube playlist ids (at most 50 per call)
+
+        Returns
+        -------
+        list of str
+            The playlist ids that no longer exist on YouTube
+        """
+        deleted_playlist_ids = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                deleted_playlist_ids.append(request_id)
+            elif isinstance(exception, HttpError) and exception.resp.status == 404:
+                logger.info("Playlist {} was already deleted".format(request_id))
+                deleted_playlist_ids.append(request_id)
+            else:
+                logger.warning("Could not delete playlist {}: {}".format(request_id, exception))
+
+        batch = self.youtube.new_batch_http_request(callback=callback)
         for playlist_id in playlist_ids:
             logger.info("Deleting playlist {}".format(playlist_id))
-            self._delete_playlist(playlist_id)
+            batch.add(self.youtube.playlists().delete(id=playlist_id), request_id=playlist_id)
+        batch.execute()
+
+        return deleted_playlist_ids
+
+    def _delete_playlists_in_batches(self, playlist_ids, batch_size=50, delete_from_database=None):
+        """Delete playlists from YouTube and the database in bounded batches.
+
+        Parameters
+        ----------
+        playlist_ids : Iterable of str
+            The YouTube playlist ids to delete
+        batch_size : int
+            How many playlists to delete per batch request (defaults to 50, the YouTube maximum)
+        delete_from_database : callable
+            Called with each batch of deleted playlist ids to remove their rows (defaults to
+            DatabaseManager.delete_playlists)
+
+        Returns
+        -------
+        int
+            The number of playlists deleted
+        """
+        if delete_from_database is None:
+            delete_from_database = self.database.delete_playlists
+        playlist_ids = iter(playlist_ids)
+        n_deleted = 0
+        while True:
+            batch = list(islice(playlist_ids, batch_size))
+            if len(batch) == 0:
+                break
+            deleted_playlist_ids = self._delete_playlists(batch)
+            delete_from_database(deleted_playlist_ids)
+            n_deleted += len(deleted_playlist_ids)
+
+        return n_deleted
+
+    def _delete_all_playlists(self):
+        """Delete all of the playlists in the database, including the roll-ups."""
+        self._delete_playlists_in_batches(self.database.iter_playlist_ids())
+        self._delete_playlists_in_batches(
+            self.database.iter_rollup_playlist_ids(),
+            delete_from_database=self.database.delete_rollup_playlists
+        )
 
         return None
 
+    def delete_expired_playlists(self, max_age_days, batch_size=50):
+        """Delete playlists older than the retention period from YouTube and the database.
+
+        Roll-up playlists are deleted once their whole week or month is older than the retention
+        period.
+
+        Parameters
+        ----------
+        max_age_days : int
+            How many days of playlists to keep
+        batch_size : int
+            How many playlists to delete per batch request (defaults to 50)
+
+        Returns
+        -------
+        int
+            The number of playlists deleted
+        """
+        cutoff = datetime.datetime.combine(
+            datetime.datetime.now().date() - datetime.timedelta(days=max_age_days),
+            datetime.time.min
+        )
+        logger.info("Deleting playlists created before {}".format(cutoff))
+        n_deleted = self._delete_playlists_in_batches(
+            self.database.iter_playlist_ids(created_before=cutoff),
+            batch_size=batch_size
+        )
+        n_deleted += self._delete_playlists_in_batches(
+            self.database.iter_rollup_playlist_ids(ended_before=cutoff),
+            batch_size=batch_size,
+            delete_from_database=self.database.delete_rollup_playlists
+        )
+        logger.info("Deleted {} expired playlists".format(n_deleted))
+        self.database.prune_video_failures()
+        self.database.prune_subreddit_updates(
+            datetime.datetime.now() - database.SUBREDDIT_UPDATES_TTL)
+
+        return n_deleted
+
 if __name__ == "__main__":
     youtube = YouTube("resources/client_secret.json")
     youtube.get_authenticated_service()